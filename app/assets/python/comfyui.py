@@ -2,13 +2,30 @@
 #them being saved to disk
 
 import os
+import sys
+import functools
+import logging
 import websocket
+from websocket import ABNF
 import uuid
-import json
-import urllib.request
+import socket
+import http.client
 from enum import StrEnum
+from typing import NamedTuple
 import random
 
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    import json
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+    json_loads = json.loads
+
+logger = logging.getLogger(__name__)
+
 ASSETS_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 SERVER_ADDRESS = "127.0.0.1:8000"
 
@@ -20,109 +37,227 @@ class ImageRatio(StrEnum):
     LANDSCAPE = "LANDSCAPE"
     PORTRAIT = "PORTRAIT"
 
-client_id = str(uuid.uuid4())
-content_prompt = "A beautiful space station in the sky, seen from the ground"
-workflow_name = "default.json"
-seed = random.randint(0, 1000000)
-steps = 15
-ratio = str(ImageRatio.LANDSCAPE)
-size = 512
+class RunCfg(NamedTuple):
+    """Parameters of a single generation run, passed explicitly instead of read from globals"""
+    client_id: str
+    prompt: str
+    workflow: str
+    seed: int
+    steps: int
+    ratio: str
+    size: int
 
 
-def queue_prompt(prompt):
-    p = {"prompt": prompt, "client_id": client_id}
-    data = json.dumps(p).encode('utf-8')
-    req =  urllib.request.Request("http://{}/prompt".format(SERVER_ADDRESS), data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+# Placeholders baked into the cached request template, replaced per run in load_prompt_request
+_CLIENT_ID_SENTINEL = "__CLIENT_ID__"
+_STEPS_SENTINEL = "__STEPS__"
+_TITLE_SENTINELS = {
+    "Ratio": "__RATIO__",
+    "Seed": "__SEED__",
+    "Size": "__SIZE__",
+    "ContentPrompt": "__PROMPT__",
+}
 
-def find_output_node_id(prompt):
-    """Find the node ID of the SaveImageWebsocket node"""
-    for node_id, node_data in prompt.items():
-        if isinstance(node_data, dict) and "class_type" in node_data:
-            if node_data["class_type"] == OUTPUT_NODE_WORKFLOW_TYPE:
-                return node_id
-    return None
-
-def get_images(ws, prompt):
-    prompt_id = queue_prompt(prompt)['prompt_id']
-    output_node_id = find_output_node_id(prompt)
+class PromptConnection(http.client.HTTPConnection):
+    """HTTP connection that sends the request headers and a bytes body in one syscall"""
+
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _send_output(self, message_body=None, encode_chunked=False):
+        # http.client sends headers and body with two send() calls, which puts them in two
+        # TCP segments once Nagle is off. This mirrors CPython 3.11's _send_output: headers
+        # are buffered in self._buffer and joined with two trailing b"" into the header
+        # block. If a newer stdlib changes that shape, this override is what breaks.
+        if (type(message_body) is not bytes or not message_body or encode_chunked
+                or not hasattr(socket.socket, "sendmsg")):
+            return super()._send_output(message_body, encode_chunked)
+        self._buffer.extend((b"", b""))
+        head = b"\r\n".join(self._buffer)
+        del self._buffer[:]
+        self._sendmsg(head, message_body)
+
+    def _sendmsg(self, head, body):
+        """Send head and body like two send() calls would, but with a single sendmsg"""
+        if self.sock is None:
+            if self.auto_open:
+                self.connect()
+            else:
+                raise http.client.NotConnected()
+        if self.debuglevel > 0:
+            print("send:", repr(head))
+            print("send:", repr(body))
+        sys.audit("http.client.send", self, head)
+        sys.audit("http.client.send", self, body)
+        sent = self.sock.sendmsg([head, body])
+        if sent < len(head):
+            self.sock.sendall(memoryview(head)[sent:])
+            self.sock.sendall(body)
+        elif sent < len(head) + len(body):
+            self.sock.sendall(memoryview(body)[sent - len(head):])
+
+# Keep-alive connection reused by every queue_prompt call
+_conn = PromptConnection(SERVER_ADDRESS)
+
+def _connect():
+    _conn.close()
+    _conn.connect()
+
+def queue_prompt(data):
+    headers = {"Content-Type": "application/json"}
+    if _conn.sock is None:
+        _connect()
+    try:
+        _conn.request("POST", "/prompt", body=data, headers=headers)
+        resp = _conn.getresponse()
+    except (http.client.BadStatusLine, ConnectionError):
+        # The server dropped the idle keep-alive socket, reconnect once and retry
+        _connect()
+        _conn.request("POST", "/prompt", body=data, headers=headers)
+        resp = _conn.getresponse()
+    body = resp.read()
+    if resp.status != 200:
+        raise http.client.HTTPException(f"Failed to queue prompt ({resp.status}): {body!r}")
+    return json_loads(body)
+
+def get_images(ws, data, output_node_id):
+    prompt_id = queue_prompt(data)['prompt_id']
     output_images = {}
-    current_node = ""
+    # Bind hot names to locals; the sink list is only looked up when the executing node changes
+    # Raw frames skip the UTF-8 decode of text frames and keep image payloads uncopied
+    recv = ws.recv_data
+    loads = json_loads
+    binary = ABNF.OPCODE_BINARY
+    text = ABNF.OPCODE_TEXT
+    target = output_node_id
+    out_list = None
     while True:
-        out = ws.recv()
-        if isinstance(out, str):
-            message = json.loads(out)
-            if message['type'] == 'executing':
-                data = message['data']
-                if data['prompt_id'] == prompt_id:
-                    if data['node'] is None:
-                        break #Execution is done
-                    else:
-                        current_node = data['node']
-        else:
-            if current_node == output_node_id:
-                if current_node not in output_images:
-                    output_images[current_node] = []
-                output_images[current_node].append(out[8:])
+        opcode, out = recv()
+        if opcode == binary:
+            # Each binary message is one complete image (websocket-client reassembles
+            # fragmented frames), so frames are kept apart rather than joined into one buffer
+            if out_list is not None:
+                out_list.append(memoryview(out)[8:])
+            continue
+        # Most text frames are progress/status updates; only parse the executing ones
+        if opcode != text or b'"executing"' not in out:
+            continue
+        message = loads(out)
+        if message.get('type') != 'executing':
+            continue
+        data = message['data']
+        if data['prompt_id'] != prompt_id:
+            continue
+        node = data['node']
+        if node is None:
+            break #Execution is done
+        out_list = output_images.setdefault(target, []) if node == target else None
 
     return output_images
 
 
 def save_images(images, output_folder):
-    for _, image in images.items():
-        with open(os.path.join(output_folder, f"{uuid.uuid4()}.png"), "wb") as f:
-            f.write(image[0])
+    frames = [frame for image in images.values() for frame in image]
+    paths = [os.path.join(output_folder, f"{os.urandom(16).hex()}.png") for _ in frames]
+    for path, frame in zip(paths, frames):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            view = memoryview(frame)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
 
-def find_node_by_title(prompt, title):
-    """Find a node by its _meta.title field"""
+def _index_prompt(prompt):
+    """Index the workflow nodes by _meta.title and by class_type in a single pass"""
+    by_title = {}
+    by_class = {}
     for node_id, node_data in prompt.items():
-        if isinstance(node_data, dict) and "_meta" in node_data:
-            if "title" in node_data["_meta"] and node_data["_meta"]["title"] == title:
-                return node_id, node_data
-    return None, None
+        if type(node_data) is not dict:
+            continue
+        class_type = node_data.get("class_type")
+        if class_type:
+            by_class.setdefault(class_type, []).append((node_id, node_data))
+        meta = node_data.get("_meta")
+        if meta:
+            title = meta.get("title")
+            if title:
+                by_title.setdefault(title, (node_id, node_data))
+    return by_title, by_class
 
-def update_node_value(prompt, title, value):
+def update_node_value(by_title, title, value):
     """Update a node's input value by finding it via _meta.title"""
-    node_id, node_data = find_node_by_title(prompt, title)
+    _, node_data = by_title.get(title, (None, None))
     if node_data and "inputs" in node_data:
         node_data["inputs"]["value"] = value
-        print(f"Updated node '{title}' (ID: {node_id}) with value: {value}")
         return True
     else:
-        print(f"Warning: Could not find node with title '{title}'")
+        logger.warning("Could not find node with title '%s'", title)
         return False
 
-def update_ksampler_steps(prompt, steps_value):
+def update_ksampler_steps(by_class, steps_value):
     """Update the KSampler node's steps value"""
-    for node_id, node_data in prompt.items():
-        if isinstance(node_data, dict) and "class_type" in node_data:
-            if node_data["class_type"] == "KSampler" and "inputs" in node_data:
-                node_data["inputs"]["steps"] = steps_value
-                print(f"Updated KSampler node (ID: {node_id}) steps to: {steps_value}")
-                return True
-    print("Warning: Could not find KSampler node")
+    for _, node_data in by_class.get("KSampler", ()):
+        if "inputs" in node_data:
+            node_data["inputs"]["steps"] = steps_value
+            return True
+    logger.warning("Could not find KSampler node")
     return False
 
-def load_prompt(workflow_name):
-    with open(os.path.join(ASSETS_FOLDER, 'workflows', workflow_name), 'r') as f:
-        prompt = json.load(f)
+@functools.lru_cache(maxsize=8)
+def _load_request_template(path, mtime_ns):
+    """Serialize the /prompt request once, with sentinel tokens in place of the per-run values"""
+    with open(path, 'rb') as f:
+        prompt = json_loads(f.read())
+    by_title, by_class = _index_prompt(prompt)
 
     # Update individual nodes by their _meta.title
-    update_node_value(prompt, "Ratio", ratio)
-    update_node_value(prompt, "ContentPrompt", content_prompt)
-    update_node_value(prompt, "Seed", seed)
-    update_node_value(prompt, "Size", float(size))
+    for title, sentinel in _TITLE_SENTINELS.items():
+        update_node_value(by_title, title, sentinel)
 
     # Update steps in the KSampler node
-    update_ksampler_steps(prompt, steps)
+    update_ksampler_steps(by_class, _STEPS_SENTINEL)
 
-    return prompt
+    output_nodes = by_class.get(OUTPUT_NODE_WORKFLOW_TYPE)
+    output_node_id = output_nodes[0][0] if output_nodes else None
+    template = json_dumps({"prompt": prompt, "client_id": _CLIENT_ID_SENTINEL})
+    return template, output_node_id
 
+def load_prompt_request(cfg):
+    """Build the serialized /prompt request body for cfg and return it with the output node id"""
+    path = os.path.join(ASSETS_FOLDER, 'workflows', cfg.workflow)
+    template, output_node_id = _load_request_template(path, os.stat(path).st_mtime_ns)
+    # The JSON-encoded sentinels are swapped for JSON-encoded values. The content prompt goes
+    # last so that user text is never scanned for other sentinels.
+    body = (
+        template
+        .replace(json_dumps(_CLIENT_ID_SENTINEL), json_dumps(cfg.client_id))
+        .replace(json_dumps(_STEPS_SENTINEL), json_dumps(cfg.steps))
+        .replace(json_dumps(_TITLE_SENTINELS["Ratio"]), json_dumps(cfg.ratio))
+        .replace(json_dumps(_TITLE_SENTINELS["Seed"]), json_dumps(cfg.seed))
+        .replace(json_dumps(_TITLE_SENTINELS["Size"]), json_dumps(float(cfg.size)))
+        .replace(json_dumps(_TITLE_SENTINELS["ContentPrompt"]), json_dumps(cfg.prompt))
+    )
+    logger.debug(
+        "Built prompt request for '%s': Ratio=%s, Seed=%s, Size=%s, steps=%s, ContentPrompt=%r",
+        cfg.workflow, cfg.ratio, cfg.seed, float(cfg.size), cfg.steps, cfg.prompt,
+    )
+    return body, output_node_id
 
-prompt = load_prompt(workflow_name)
+cfg = RunCfg(
+    client_id=str(uuid.uuid4()),
+    prompt="A beautiful space station in the sky, seen from the ground",
+    workflow="default.json",
+    seed=random.randint(0, 1000000),
+    steps=15,
+    ratio=str(ImageRatio.LANDSCAPE),
+    size=512,
+)
+data, output_node_id = load_prompt_request(cfg)
 ws = websocket.WebSocket()
-ws.connect("ws://{}/ws?clientId={}".format(SERVER_ADDRESS, client_id))
-images = get_images(ws, prompt)
+ws.connect("ws://{}/ws?clientId={}".format(SERVER_ADDRESS, cfg.client_id))
+images = get_images(ws, data, output_node_id)
 ws.close() # for in case this example is used in an environment where it will be repeatedly called, like in a Gradio app. otherwise, you'll randomly receive connection timeouts
 #Commented out code to display the output images:
 save_images(images, os.path.join(ASSETS_FOLDER, 'images'))